@@ -1,5 +1,7 @@
 import asyncio
+import contextlib
 import os
+from collections import deque
 from pathlib import Path
 from typing import Optional, override, AsyncGenerator
 
@@ -13,6 +15,7 @@ from google.genai import types
 from acp import Client, ClientSideConnection, PROTOCOL_VERSION, RequestError, text_block
 from acp.schema import (
     AllowedOutcome,
+    CancelNotification,
     ClientCapabilities,
     DeniedOutcome,
     FileSystemCapability,
@@ -37,24 +40,84 @@ from acp.schema import (
 DOCKERFILE_PROMPT = "Create or update apropriate Dockerfile"
 DOCUMENTATION_PROMPT = "Update GEMINI.md with informations in this session"
 
+# Fixed prompt blocks, built once at import
+_DOCKERFILE_BLOCKS = [text_block(DOCKERFILE_PROMPT)]
+_DOCS_BLOCKS = [text_block(DOCUMENTATION_PROMPT)]
+
+# Maximum number of Gemini CLI sessions kept for reuse, across all ADK
+# sessions and directories. This only bounds the local cache; ACP has no way
+# to close a session, so evicted sessions stay alive in Gemini CLI
+MAX_SESSIONS = 32
+
+# Docker build output is grouped into events of up to DOCKER_BATCH_LINES lines,
+# flushed early after DOCKER_FLUSH_DELAY seconds without new output
+DOCKER_PREFIX = "[Docker] "
+DOCKER_BATCH_LINES = 32
+DOCKER_FLUSH_DELAY = 0.2
+
+# Number of recent Gemini CLI stderr lines kept for error reports
+STDERR_LINES = 256
+
+# Permission option kinds that are auto-approved
+ALLOW_KINDS = frozenset({"allow_once", "allow_always"})
+
+# Author of all events yielded by CodingAgent
+EVENT_AUTHOR = 'coding'
+
+
+def _format_message_chunk(update: AgentMessageChunk) -> Optional[str]:
+    if isinstance(update.content, TextContentBlock):
+        return update.content.text
+    return None
+
+
+def _format_thought_chunk(update: AgentThoughtChunk) -> Optional[str]:
+    if isinstance(update.content, TextContentBlock):
+        return f"[Thought] {update.content.text}"
+    return None
+
+
+def _format_tool_call_start(update: ToolCallStart) -> Optional[str]:
+    return f"[Tool] {update.title}"
+
+
+def _format_tool_call_progress(update: ToolCallProgress) -> Optional[str]:
+    if update.status == "completed":
+        return "[Tool] Completed"
+    return None
+
+
+# Session update formatters keyed by exact update type
+_FORMATTERS = {
+    AgentMessageChunk: _format_message_chunk,
+    AgentThoughtChunk: _format_thought_chunk,
+    ToolCallStart: _format_tool_call_start,
+    ToolCallProgress: _format_tool_call_progress,
+}
+
 
 class GeminiClient(Client):
     """Auto-approving client for Gemini CLI integration."""
 
-    def __init__(self, event_queue: asyncio.Queue):
-        self.event_queue = event_queue
+    def __init__(self, event_deque: deque, event_ready: asyncio.Event):
+        self.event_deque = event_deque
+        self.event_ready = event_ready
 
     async def requestPermission(
         self, params: RequestPermissionRequest
     ) -> RequestPermissionResponse:
         """Auto-approve all permissions."""
         try:
-            # Find first allow option
-            for option in params.options:
-                if option.kind in {"allow_once", "allow_always"}:
-                    return RequestPermissionResponse(
-                        outcome=AllowedOutcome(optionId=option.optionId, outcome="selected")
-                    )
+            # Find first allow option, usually the first one offered
+            options = params.options
+            if options and options[0].kind in ALLOW_KINDS:
+                option = options[0]
+            else:
+                option = next((o for o in options if o.kind in ALLOW_KINDS), None)
+            if option is not None:
+                return RequestPermissionResponse(
+                    outcome=AllowedOutcome(optionId=option.optionId, outcome="selected")
+                )
             return RequestPermissionResponse(outcome=DeniedOutcome(outcome="cancelled"))
         except Exception:
             # Silently ignore all exceptions
@@ -63,7 +126,8 @@ class GeminiClient(Client):
     async def sessionUpdate(self, params: SessionNotification) -> None:
         """Queue session updates as events."""
         try:
-            await self.event_queue.put(params.update)
+            self.event_deque.append(params.update)
+            self.event_ready.set()
         except Exception:
             # Silently ignore all exceptions
             pass
@@ -78,8 +142,9 @@ class GeminiClient(Client):
                 raise RequestError.invalid_params(
                     {"path": params.path, "reason": "path must be absolute"}
                 )
-            path.parent.mkdir(parents=True, exist_ok=True)
-            path.write_text(params.content)
+            # Keep blocking file IO off the event loop
+            await asyncio.to_thread(path.parent.mkdir, parents=True, exist_ok=True)
+            await asyncio.to_thread(path.write_text, params.content)
             return WriteTextFileResponse()
         except Exception:
             # Silently ignore all exceptions
@@ -102,7 +167,8 @@ class GeminiClient(Client):
                     message=f"File does not exist: {params.path}",
                     data={"path": params.path, "reason": "file does not exist"}
                 )
-            text = path.read_text()
+            # Keep blocking file IO off the event loop
+            text = await asyncio.to_thread(path.read_text)
             return ReadTextFileResponse(content=text)
         except Exception:
             # Silently ignore all exceptions
@@ -118,6 +184,18 @@ class CodingAgent(BaseAgent):
         super().__init__(**kwargs)
         self._gemini_proc = None
         self._gemini_conn = None
+        self._stderr_task = None
+        # Recent Gemini CLI stderr lines, surfaced only on errors
+        self._gemini_stderr = deque(maxlen=STDERR_LINES)
+        # Session updates from the single GeminiClient producer, consumed by
+        # _stream_until_done on the same event loop
+        self._event_deque = deque()
+        self._event_ready = asyncio.Event()
+        # Gemini CLI session ids by (ADK session id, working directory), least
+        # recently used first
+        self._sessions: dict[tuple[str, str], str] = {}
+        # Working directory paths, by directory from state
+        self._dir_cache: dict[str, str] = {}
 
     async def _ensure_gemini_client(self):
         """Create Gemini CLI client if it doesn't exist."""
@@ -129,15 +207,13 @@ class CodingAgent(BaseAgent):
                 "-y",
                 stdin=asyncio.subprocess.PIPE,
                 stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
                 limit=10 * 1024 * 1024,  # 10MB buffer to handle large outputs
             )
-
-            # Create event queue for session updates
-            self._event_queue = asyncio.Queue()
+            self._stderr_task = asyncio.create_task(self._drain_stderr())
 
             # Create connection
-            client = GeminiClient(self._event_queue)
+            client = GeminiClient(self._event_deque, self._event_ready)
             self._gemini_conn = ClientSideConnection(
                 lambda _: client, self._gemini_proc.stdin, self._gemini_proc.stdout
             )
@@ -152,6 +228,64 @@ class CodingAgent(BaseAgent):
                 )
             )
 
+    async def _drain_stderr(self) -> None:
+        """Keep the tail of Gemini CLI stderr for error reports."""
+        stderr = self._gemini_proc.stderr
+        # Keep draining whatever happens, a full pipe would block Gemini CLI
+        tail = b''
+        while True:
+            try:
+                chunk = await stderr.read(64 * 1024)
+            except Exception:
+                # Silently ignore all exceptions, the stream is unusable
+                break
+            if not chunk:
+                break
+            # Carry a partial last line over to the next read, bounded in
+            # case the CLI never writes a newline
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop()[-64 * 1024:]
+            self._gemini_stderr.extend(
+                line.decode('utf-8', 'replace').rstrip() for line in lines
+            )
+
+        if tail:
+            self._gemini_stderr.append(tail.decode('utf-8', 'replace').rstrip())
+
+    async def _get_session(self, adk_session_id: str, dir_path: str) -> str:
+        """Return Gemini CLI session for ADK session in dir_path, creating it if needed."""
+        # Never share a Gemini conversation between ADK sessions
+        key = (adk_session_id, dir_path)
+        session_id = self._sessions.pop(key, None)
+        if session_id is None:
+            session = await self._gemini_conn.newSession(
+                NewSessionRequest(cwd=dir_path, mcpServers=[])
+            )
+            session_id = session.sessionId
+
+        # Re-insert as most recently used and evict the oldest sessions
+        self._sessions[key] = session_id
+        while len(self._sessions) > MAX_SESSIONS:
+            self._sessions.pop(next(iter(self._sessions)))
+        return session_id
+
+    async def _prompt(
+        self, adk_session_id: str, dir_path: str, session_id: str, prompt: list
+        ) -> None:
+        """Send prompt, cancelling the turn in Gemini CLI if interrupted."""
+        try:
+            await self._gemini_conn.prompt(
+                PromptRequest(sessionId=session_id, prompt=prompt)
+            )
+        except BaseException:
+            # Don't reuse a session that may still be busy with this turn
+            key = (adk_session_id, dir_path)
+            if self._sessions.get(key) == session_id:
+                del self._sessions[key]
+            with contextlib.suppress(Exception):
+                await self._gemini_conn.cancel(CancelNotification(sessionId=session_id))
+            raise
+
     @override
     async def _run_async_impl(
         self, ctx: InvocationContext
@@ -162,211 +296,204 @@ class CodingAgent(BaseAgent):
 
         # Combine root_dir with directory from state
         directory = ctx.session.state.get('directory', '')
-        dir_path = os.path.join(self.root_dir, directory)
-
-        user_request = ctx.session.events[-1].content.parts[0].text
-
-        if not os.path.exists(dir_path):
-            # Create empty dir for now, create it from template in the future
-            os.makedirs(dir_path, exist_ok=True)
-
-        # Create Gemini CLI session with dir_path as working directory
-        session = await self._gemini_conn.newSession(
-            NewSessionRequest(cwd=dir_path, mcpServers=[])
+        dir_path = self._dir_cache.get(directory)
+        if dir_path is None:
+            dir_path = os.path.join(self.root_dir, directory)
+            self._dir_cache[directory] = dir_path
+
+        # Create empty dir for now, create it from template in the future.
+        # Checked on every request in case it was removed in between
+        Path(dir_path).mkdir(parents=True, exist_ok=True)
+
+        last_event = ctx.session.events[-1]
+        user_request = last_event.content.parts[0].text
+
+        # Image tag - use repo/directory if configured, otherwise just directory
+        if self.docker_repo and directory:
+            image_tag = f"{self.docker_repo}/{directory}"
+        elif directory:
+            image_tag = directory
+        else:
+            image_tag = None
+
+        # Run prompts in background and yield events from their updates
+        run_task = asyncio.create_task(
+            self._run_prompts(ctx.session.id, dir_path, user_request, image_tag)
         )
-
-        # Send user request to Gemini CLI in background
-        prompt_task = asyncio.create_task(
-            self._gemini_conn.prompt(
-                PromptRequest(
-                    sessionId=session.sessionId,
-                    prompt=[text_block(user_request)],
+        try:
+            async with contextlib.aclosing(self._stream_until_done(run_task)) as events:
+                async for event in events:
+                    yield event
+            run_task.result()
+        except Exception as e:
+            # Report the underlying errors rather than the TaskGroup wrapper
+            errors = e.exceptions if isinstance(e, ExceptionGroup) else [e]
+            for error in errors:
+                yield self._mk_event(f"Error: {error}")
+
+            # Surface recent Gemini CLI stderr to help diagnose the failure
+            if self._gemini_proc is not None and self._gemini_proc.returncode is not None:
+                yield self._mk_event(
+                    f"Error: Gemini CLI exited with code {self._gemini_proc.returncode}"
                 )
+            if self._gemini_stderr:
+                stderr = "\n".join(self._gemini_stderr)
+                self._gemini_stderr.clear()
+                yield self._mk_event(f"[Gemini stderr]\n{stderr}")
+        finally:
+            # Cancelling the run also cancels every task it started, and
+            # waiting for it lets interrupted prompts be cancelled in Gemini CLI
+            if not run_task.done():
+                run_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await run_task
+
+    async def _run_prompts(
+        self,
+        adk_session_id: str,
+        dir_path: str,
+        user_request: str,
+        image_tag: Optional[str],
+        ) -> None:
+        """Run user request, follow-up prompts and docker build."""
+        # Reuse this ADK session's Gemini CLI session with dir_path as working directory
+        session_id = await self._get_session(adk_session_id, dir_path)
+
+        # Send user request to Gemini CLI
+        await self._prompt(adk_session_id, dir_path, session_id, [text_block(user_request)])
+
+        # Send follow-up message for Dockerfile
+        await self._prompt(adk_session_id, dir_path, session_id, _DOCKERFILE_BLOCKS)
+
+        # Documentation continues the same session after the Dockerfile, so
+        # it sees all the work done. Start building meanwhile
+        async with asyncio.TaskGroup() as tg:
+            if image_tag:
+                tg.create_task(self._build_image(image_tag, dir_path))
+            tg.create_task(self._prompt(adk_session_id, dir_path, session_id, _DOCS_BLOCKS))
+
+    def _emit(self, text: str) -> None:
+        """Queue preformatted text alongside session updates."""
+        self._event_deque.append(text)
+        self._event_ready.set()
+
+    async def _build_image(self, image_tag: str, dir_path: str) -> None:
+        """Build docker image in dir_path, queueing its output as events."""
+        self._emit(f"[Docker] Building image: {image_tag}")
+
+        process = None
+        try:
+            # Build docker image directly
+            process = await asyncio.create_subprocess_exec(
+                'docker', 'build', '-t', image_tag, '.',
+                cwd=dir_path,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                limit=1024 * 1024,  # 1MB buffer for chatty builds
             )
-        )
 
-        # Yield events from Gemini CLI session updates
-        try:
+            # Stream output in chunks, carrying a partial last line over to
+            # the next read. Lines are buffered across reads and flushed when
+            # the batch is full, at EOF, or when the build goes quiet
+            tail = b''
+            buffer: list[bytes] = []
             while True:
-                # Wait for either an event or the prompt to complete
-                done, pending = await asyncio.wait(
-                    [
-                        asyncio.create_task(self._event_queue.get()),
-                        prompt_task
-                    ],
-                    return_when=asyncio.FIRST_COMPLETED
-                )
-
-                # Check if prompt completed
-                if prompt_task in done:
-                    # Drain any remaining events
-                    while not self._event_queue.empty():
-                        update = await self._event_queue.get()
-                        event_text = self._format_update(update)
-                        if event_text:
-                            yield Event(
-                                author='coding',
-                                content=types.Content(parts=[types.Part(text=event_text)])
-                            )
-
-                    # Send follow-up messages for Dockerfile and documentation
-                    dockerfile_task = asyncio.create_task(
-                        self._gemini_conn.prompt(
-                            PromptRequest(
-                                sessionId=session.sessionId,
-                                prompt=[text_block(DOCKERFILE_PROMPT)],
-                            )
-                        )
-                    )
-
-                    # Wait for Dockerfile task and yield its events
-                    while True:
-                        if dockerfile_task.done():
-                            while not self._event_queue.empty():
-                                update = await self._event_queue.get()
-                                event_text = self._format_update(update)
-                                if event_text:
-                                    yield Event(
-                                        author='coding',
-                                        content=types.Content(parts=[types.Part(text=event_text)])
-                                    )
-                            break
-
-                        try:
-                            update = await asyncio.wait_for(self._event_queue.get(), timeout=0.1)
-                            event_text = self._format_update(update)
-                            if event_text:
-                                yield Event(
-                                    author='coding',
-                                    content=types.Content(parts=[types.Part(text=event_text)])
-                                )
-                        except asyncio.TimeoutError:
-                            continue
-
-                    # Send documentation update message
-                    docs_task = asyncio.create_task(
-                        self._gemini_conn.prompt(
-                            PromptRequest(
-                                sessionId=session.sessionId,
-                                prompt=[text_block(DOCUMENTATION_PROMPT)],
-                            )
-                        )
-                    )
-
-                    # Wait for docs task and yield its events
-                    while True:
-                        if docs_task.done():
-                            while not self._event_queue.empty():
-                                update = await self._event_queue.get()
-                                event_text = self._format_update(update)
-                                if event_text:
-                                    yield Event(
-                                        author='coding',
-                                        content=types.Content(parts=[types.Part(text=event_text)])
-                                    )
-                            break
-
-                        try:
-                            update = await asyncio.wait_for(self._event_queue.get(), timeout=0.1)
-                            event_text = self._format_update(update)
-                            if event_text:
-                                yield Event(
-                                    author='coding',
-                                    content=types.Content(parts=[types.Part(text=event_text)])
-                                )
-                        except asyncio.TimeoutError:
-                            continue
-
-                    # Build docker image - use repo/directory if configured, otherwise just directory
-                    if self.docker_repo and directory:
-                        image_tag = f"{self.docker_repo}/{directory}"
-                    elif directory:
-                        image_tag = directory
+                try:
+                    if buffer:
+                        async with asyncio.timeout(DOCKER_FLUSH_DELAY):
+                            chunk = await process.stdout.read(64 * 1024)
                     else:
-                        image_tag = None
-
-                    if image_tag:
-                        yield Event(
-                            author='coding',
-                            content=types.Content(parts=[types.Part(text=f"[Docker] Building image: {image_tag}")])
-                        )
-
-                        try:
-                            # Build docker image directly
-                            process = await asyncio.create_subprocess_exec(
-                                'docker', 'build', '-t', image_tag, '.',
-                                cwd=dir_path,
-                                stdout=asyncio.subprocess.PIPE,
-                                stderr=asyncio.subprocess.STDOUT
-                            )
-
-                            # Stream output line by line
-                            while True:
-                                line = await process.stdout.readline()
-                                if not line:
-                                    break
-                                output = line.decode('utf-8').rstrip()
-                                if output:
-                                    yield Event(
-                                        author='coding',
-                                        content=types.Content(parts=[types.Part(text=f"[Docker] {output}")])
-                                    )
-
-                            await process.wait()
-
-                            if process.returncode == 0:
-                                yield Event(
-                                    author='coding',
-                                    content=types.Content(parts=[types.Part(text=f"[Docker] Successfully built image: {image_tag}")])
-                                )
-                            else:
-                                yield Event(
-                                    author='coding',
-                                    content=types.Content(parts=[types.Part(text=f"[Docker] Build failed with exit code: {process.returncode}")])
-                                )
-                        except Exception as e:
-                            yield Event(
-                                author='coding',
-                                content=types.Content(parts=[types.Part(text=f"[Docker] Error building image: {e}")])
-                            )
+                        chunk = await process.stdout.read(64 * 1024)
+                except TimeoutError:
+                    self._emit_docker_output(buffer)
+                    buffer = []
+                    continue
+                if not chunk:
+                    break
+                lines = (tail + chunk).split(b'\n')
+                tail = lines.pop()
+                buffer.extend(stripped for line in lines if (stripped := line.rstrip()))
+                while len(buffer) >= DOCKER_BATCH_LINES:
+                    self._emit_docker_output(buffer[:DOCKER_BATCH_LINES])
+                    del buffer[:DOCKER_BATCH_LINES]
+
+            if tail.rstrip():
+                buffer.append(tail.rstrip())
+            self._emit_docker_output(buffer)
+
+            await process.wait()
+
+            if process.returncode == 0:
+                self._emit(f"[Docker] Successfully built image: {image_tag}")
+            else:
+                self._emit(f"[Docker] Build failed with exit code: {process.returncode}")
+        except Exception as e:
+            self._emit(f"[Docker] Error building image: {e}")
+        finally:
+            # Don't leave the build running if we were cancelled
+            if process is not None and process.returncode is None:
+                process.kill()
+
+    def _emit_docker_output(self, lines: list[bytes]) -> None:
+        """Queue non-empty docker output lines as a single event."""
+        if lines:
+            text = b'\n'.join(lines).decode('utf-8', 'replace')
+            self._emit(DOCKER_PREFIX + text.replace("\n", "\n" + DOCKER_PREFIX))
+
+    def _mk_event(self, text: str) -> Event:
+        """Wrap text into an event."""
+        return Event(
+            author=EVENT_AUTHOR,
+            content=types.Content(parts=[types.Part(text=text)])
+        )
 
+    async def _stream_until_done(
+        self, *tasks: asyncio.Task
+        ) -> AsyncGenerator[Event, None]:
+        """Yield events from session updates until all tasks complete."""
+        # Bind per-token lookups once for the loop below
+        events = self._event_deque
+        popleft = events.popleft
+        ready = self._event_ready
+        format_update = self._format_update
+        mk_event = self._mk_event
+
+        # Keep a single pending wait across iterations and re-arm it only
+        # after it fires
+        wait_task = None
+        try:
+            while True:
+                # Drain everything already queued in the same wakeup
+                while events:
+                    event_text = format_update(popleft())
+                    if event_text:
+                        yield mk_event(event_text)
+
+                pending = {task for task in tasks if not task.done()}
+                if not pending:
                     break
 
-                # Process event
-                for task in done:
-                    if task != prompt_task:
-                        update = task.result()
-                        event_text = self._format_update(update)
-                        if event_text:
-                            yield Event(
-                                author='coding',
-                                content=types.Content(parts=[types.Part(text=event_text)])
-                            )
+                ready.clear()
+                if wait_task is None:
+                    wait_task = asyncio.ensure_future(ready.wait())
 
-        except Exception as e:
-            yield Event(
-                author='coding',
-                content=types.Content(parts=[types.Part(text=f"Error: {e}")])
-            )
+                done, _ = await asyncio.wait(
+                    {wait_task, *pending},
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+
+                if wait_task in done:
+                    wait_task = None
         finally:
-            # Cancel prompt task if still running
-            if not prompt_task.done():
-                prompt_task.cancel()
+            if wait_task is not None:
+                wait_task.cancel()
 
     def _format_update(self, update) -> Optional[str]:
-        """Format session update into text."""
-        if isinstance(update, AgentMessageChunk):
-            if isinstance(update.content, TextContentBlock):
-                return update.content.text
-        elif isinstance(update, AgentThoughtChunk):
-            if isinstance(update.content, TextContentBlock):
-                return f"[Thought] {update.content.text}"
-        elif isinstance(update, ToolCallStart):
-            return f"[Tool] {update.title}"
-        elif isinstance(update, ToolCallProgress):
-            if update.status == "completed":
-                return f"[Tool] Completed"
-        return None
+        """Format session update, or preformatted text, into text."""
+        if type(update) is str:
+            return update
+        formatter = _FORMATTERS.get(type(update))
+        return formatter(update) if formatter else None
 
 
 root_agent = CodingAgent(name='coder', root_dir=os.getcwd())
@@ -1,5 +1,5 @@
 # Load env variables
-from typing import List
+from typing import Any, Dict
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -8,9 +8,14 @@ import time
 
 import os
 import uuid
-import json
 import argparse
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
 from google.adk.runners import Runner
 from google.adk.sessions import InMemorySessionService
 from google.adk.artifacts import InMemoryArtifactService
@@ -48,7 +53,15 @@ runner = Runner(
     artifact_service=artifact_service
 )
 
-async def single_run(prompts: List[str]):
+async def single_run(prompts: Dict[str, Any]):
+    """Run all queries of a test case in one session.
+
+    Test case schema:
+        {
+            "state": {"directory": "test"},  # optional initial session state
+            "queries": ["..."]               # user prompts, run in order
+        }
+    """
     session_id = str(uuid.uuid4())
     session = await session_service.create_session(
         app_name=APP_NAME, user_id=USER_ID, session_id=session_id
@@ -95,8 +108,9 @@ async def main():
     parser.add_argument('--input', default='tests.jsonl', help='Input file path')
     args = parser.parse_args()
 
-    with open(args.input,'r') as f:
-        test_case = json.load(f)
+    with open(args.input,'rb') as f:
+        data = f.read()
+    test_case = orjson.loads(data) if orjson else json.loads(data)
 
     # sequential to limit load on models
     await single_run(test_case)
@@ -105,4 +119,14 @@ async def main():
 if __name__ == "__main__":
     import asyncio
 
-    asyncio.run(main())
\ No newline at end of file
+    # Use uvloop as faster event loop when installed
+    try:
+        import uvloop
+        loop_factory = uvloop.new_event_loop
+    except ImportError:
+        loop_factory = None
+
+    with asyncio.Runner(loop_factory=loop_factory) as asyncio_runner:
+        # Most tasks here finish without blocking, start them eagerly
+        asyncio_runner.get_loop().set_task_factory(asyncio.eager_task_factory)
+        asyncio_runner.run(main())